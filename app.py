@@ -1,20 +1,37 @@
+import hashlib
+import hmac
 import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from functools import wraps
+from functools import lru_cache, wraps
 from zoneinfo import ZoneInfo
 
 import cloudinary
+import cloudinary.api
 import cloudinary.uploader
+import cloudinary.utils
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
-from flask import (Flask, flash, g, redirect, render_template,
-                   request, session, url_for)
+from flask import (Flask, flash, g, jsonify, make_response, redirect,
+                   render_template, request, session, url_for)
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.security import check_password_hash
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.environ["SECRET_KEY"]
+# Compiled templates are shared on disk so fresh workers skip parsing them.
+# With no directory, Jinja uses a private per-user cache dir (mode 0700,
+# ownership checked) under the temp dir.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 EASTERN = ZoneInfo("America/New_York")
 
@@ -35,74 +52,156 @@ cloudinary.config(
     api_secret=os.environ["CLOUDINARY_API_SECRET"],
 )
 
+
+@app.template_filter("cld_url")
+@lru_cache(maxsize=4096)
+def cld_url(public_id, w):
+    """Delivery URL for an image, resized to at most w pixels wide in the browser's best format."""
+    return cloudinary.utils.cloudinary_url(
+        public_id, fetch_format="auto", quality="auto", width=w, crop="limit", secure=True,
+    )[0]
+
 DATABASE = os.environ.get("DATABASE", "photos.db")
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD_HASH = os.environ["ADMIN_PASSWORD_HASH"]
+PAGE_SIZE = 24
+
+# Cloudinary calls are network-bound, so a handful of threads lets a
+# multi-file post upload in parallel instead of one file after another.
+_CLOUDINARY_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cloudinary")
+_UPLOAD_CHUNK_SIZE = 6_000_000  # Cloudinary's minimum chunk is 5MB
 
 
 # ---------------------------------------------------------------------------
 # Database helpers
 # ---------------------------------------------------------------------------
 
+# Connections are kept open for the life of the process so SQLite's page
+# cache survives between requests. Reads borrow a pooled connection per
+# request; all writes go through one writer connection behind a lock.
+_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -64000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA foreign_keys = ON",
+)
+_READ_POOL = queue.LifoQueue()
+_WRITE_LOCK = threading.Lock()
+_write_conn = None
+
+
+def connect_db(isolation_level=""):
+    db = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=isolation_level)
+    db.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
 def get_db():
+    """Return this request's read connection, borrowing one from the pool if needed."""
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-        db.execute("PRAGMA foreign_keys = ON")
+        try:
+            db = _READ_POOL.get_nowait()
+        except queue.Empty:
+            db = connect_db()
+        g._database = db
     return db
 
 
 @app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
+def release_connection(exception):
+    db = g.pop("_database", None)
     if db is not None:
-        db.close()
+        if db.in_transaction:
+            db.rollback()
+        _READ_POOL.put(db)
+
+
+@contextmanager
+def write_db():
+    """Hold the process-wide writer connection; anything left uncommitted is rolled back."""
+    global _write_conn
+    with _WRITE_LOCK:
+        if _write_conn is None:
+            # Take the write lock when the transaction starts, not on its first
+            # write, so concurrent workers wait on busy_timeout instead of
+            # failing with SQLITE_BUSY mid-transaction.
+            _write_conn = connect_db(isolation_level="IMMEDIATE")
+        try:
+            yield _write_conn
+        finally:
+            if _write_conn.in_transaction:
+                _write_conn.rollback()
 
 
 def init_db():
-    with app.app_context():
-        db = get_db()
+    with write_db() as db:
         with app.open_resource("schema.sql", mode="r") as f:
             db.cursor().executescript(f.read())
         db.commit()
 
 
+# Migrations open their transaction explicitly: sqlite3 only begins one
+# implicitly before DML, and the ALTERs and the user_version bump must
+# commit together. Checking the version inside it also keeps two workers
+# starting at once from both applying the same step.
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
 def migrate_media_type():
     """Add media_type column to photos and post_images if not present."""
-    with app.app_context():
-        db = get_db()
-        for table in ("photos", "post_images"):
-            cols = [r[1] for r in db.execute(f"PRAGMA table_info({table})").fetchall()]
-            if "media_type" not in cols:
-                db.execute(f"ALTER TABLE {table} ADD COLUMN media_type TEXT NOT NULL DEFAULT 'image'")
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 1:
+            return
+        tables = db.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name IN (?, ?)",
+            ("photos", "post_images"),
+        ).fetchall()
+        for t in tables:
+            if "media_type" not in t["sql"]:
+                db.execute(f"ALTER TABLE {t['name']} ADD COLUMN media_type TEXT NOT NULL DEFAULT 'image'")
+        db.execute("PRAGMA user_version = 1")
         db.commit()
 
 
 def migrate_comment_likes():
     """Add liked column to comments if not present."""
-    with app.app_context():
-        db = get_db()
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 3:
+            return
         cols = [r[1] for r in db.execute("PRAGMA table_info(comments)").fetchall()]
         if "liked" not in cols:
             db.execute("ALTER TABLE comments ADD COLUMN liked INTEGER NOT NULL DEFAULT 0")
+        db.execute("PRAGMA user_version = 3")
         db.commit()
 
 
 def migrate_comment_replies():
     """Add parent_id column to comments if not present."""
-    with app.app_context():
-        db = get_db()
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 4:
+            return
         cols = [r[1] for r in db.execute("PRAGMA table_info(comments)").fetchall()]
         if "parent_id" not in cols:
             db.execute("ALTER TABLE comments ADD COLUMN parent_id INTEGER REFERENCES comments(id) ON DELETE CASCADE")
+        db.execute("PRAGMA user_version = 4")
         db.commit()
 
 
 def migrate_post_images():
     """Populate post_images for any existing photos that don't have entries yet."""
-    with app.app_context():
-        db = get_db()
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 2:
+            return
         orphans = db.execute(
             """SELECT p.id, p.cloudinary_url, p.cloudinary_public_id
                FROM photos p
@@ -114,17 +213,129 @@ def migrate_post_images():
                 "INSERT INTO post_images (photo_id, cloudinary_url, cloudinary_public_id, display_order) VALUES (?, ?, ?, 0)",
                 (p["id"], p["cloudinary_url"], p["cloudinary_public_id"]),
             )
+        db.execute("PRAGMA user_version = 2")
+        db.commit()
+
+
+def migrate_image_count():
+    """Add image_count column to photos if not present and backfill it from post_images."""
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 5:
+            return
+        cols = [r[1] for r in db.execute("PRAGMA table_info(photos)").fetchall()]
+        if "image_count" not in cols:
+            db.execute("ALTER TABLE photos ADD COLUMN image_count INTEGER NOT NULL DEFAULT 1")
+            db.execute(
+                """UPDATE photos SET image_count = MAX(1, (
+                       SELECT COUNT(*) FROM post_images pi WHERE pi.photo_id = photos.id))"""
+            )
+        db.execute("PRAGMA user_version = 5")
+        db.commit()
+
+
+def migrate_photos_created_index():
+    """Drop idx_photos_created, superseded by idx_photos_created_id in schema.sql."""
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 6:
+            return
+        db.execute("DROP INDEX IF EXISTS idx_photos_created")
+        db.execute("PRAGMA user_version = 6")
+        db.commit()
+
+
+# gallery_version changes whenever anything the gallery shows changes, and
+# photos.version whenever anything that post's page shows changes.
+_VERSION_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS photos_insert_version AFTER INSERT ON photos
+       BEGIN
+           UPDATE gallery_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_delete_version AFTER DELETE ON photos
+       BEGIN
+           UPDATE gallery_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_update_version
+       AFTER UPDATE OF cloudinary_url, cloudinary_public_id, media_type, caption, image_count, created_at ON photos
+       BEGIN
+           UPDATE gallery_version SET version = version + 1;
+           UPDATE photos SET version = version + 1 WHERE id = NEW.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_insert_version AFTER INSERT ON comments
+       BEGIN
+           UPDATE photos SET version = version + 1 WHERE id = NEW.photo_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_update_version AFTER UPDATE ON comments
+       BEGIN
+           UPDATE photos SET version = version + 1 WHERE id IN (OLD.photo_id, NEW.photo_id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS comments_delete_version AFTER DELETE ON comments
+       BEGIN
+           UPDATE photos SET version = version + 1 WHERE id = OLD.photo_id;
+       END""",
+)
+
+
+def migrate_photo_version():
+    """Add photos.version and the triggers that keep it and gallery_version current."""
+    with write_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        if schema_version(db) >= 7:
+            return
+        cols = [r[1] for r in db.execute("PRAGMA table_info(photos)").fetchall()]
+        if "version" not in cols:
+            db.execute("ALTER TABLE photos ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        for trigger in _VERSION_TRIGGERS:
+            db.execute(trigger)
+        db.execute("PRAGMA user_version = 7")
         db.commit()
 
 
+_VIDEO_EXT = frozenset({".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v"})
+
+
 def detect_media_type(file):
-    ct = (file.content_type or "").lower()
-    if ct.startswith("video/"):
-        return "video"
-    ext = os.path.splitext(file.filename or "")[1].lower()
-    if ext in {".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v"}:
+    ct = file.content_type
+    if ct and ct[:6].lower() == "video/":
         return "video"
-    return "image"
+    fn = file.filename or ""
+    i = fn.rfind(".")
+    return "video" if i >= 0 and fn[i:].lower() in _VIDEO_EXT else "image"
+
+
+def upload_to_cloudinary(file):
+    """Upload one file and return (secure_url, public_id, media_type)."""
+    mtype = detect_media_type(file)
+    # Send the spooled upload in fixed-size chunks rather than building the
+    # whole file into one multipart body in memory.
+    result = cloudinary.uploader.upload_large(
+        file.stream,
+        filename=file.filename,
+        chunk_size=_UPLOAD_CHUNK_SIZE,
+        folder="sharayunet",
+        resource_type="auto",
+    )
+    return result["secure_url"], result["public_id"], mtype
+
+
+def delete_from_cloudinary(assets):
+    """Queue bulk deletes of assets from Cloudinary, one call per resource type, without waiting."""
+    buckets = {}
+    for a in assets:
+        rtype = "video" if a["media_type"] == "video" else "image"
+        buckets.setdefault(rtype, []).append(a["cloudinary_public_id"])
+    # delete_resources accepts at most 100 public ids per call
+    for rtype, ids in buckets.items():
+        for i in range(0, len(ids), 100):
+            fut = _CLOUDINARY_POOL.submit(cloudinary.api.delete_resources, ids[i:i + 100], resource_type=rtype)
+            fut.add_done_callback(_log_delete_failure)
+
+
+def _log_delete_failure(fut):
+    exc = fut.exception()
+    if exc is not None:
+        app.logger.error("Cloudinary delete failed: %s", exc)
 
 
 # ---------------------------------------------------------------------------
@@ -141,6 +352,112 @@ def login_required(f):
     return decorated
 
 
+# Password hashing is deliberately slow, so remember recent verdicts (keyed by
+# an HMAC of the password, never the password itself) and cap failed attempts
+# per client.
+_LOGIN_TTL = 60
+_LOGIN_MAX_FAILURES = 5
+_LOGIN_CACHE = {}
+_LOGIN_FAILURES = defaultdict(deque)
+_LOGIN_LOCK = threading.Lock()
+
+
+_PASSWORD_HASHER = PasswordHasher()
+
+
+def verify_password_hash(pwhash, password):
+    """Check a password against an argon2 hash, or an older werkzeug one."""
+    if not pwhash.startswith("$argon2"):
+        return check_password_hash(pwhash, password)
+    try:
+        return _PASSWORD_HASHER.verify(pwhash, password)
+    except (VerificationError, InvalidHashError):  # wrong password or malformed hash
+        return False
+
+
+def check_admin_password(password):
+    key = hmac.new(app.secret_key.encode(), password.encode(), "sha256").digest()
+    now = time.monotonic()
+    with _LOGIN_LOCK:
+        hit = _LOGIN_CACHE.get(key)
+        if hit is not None and now - hit[0] < _LOGIN_TTL:
+            return hit[1]
+    ok = verify_password_hash(ADMIN_PASSWORD_HASH, password)
+    with _LOGIN_LOCK:
+        for k in [k for k, (t, _) in _LOGIN_CACHE.items() if now - t >= _LOGIN_TTL]:
+            del _LOGIN_CACHE[k]
+        _LOGIN_CACHE[key] = (now, ok)
+    return ok
+
+
+def client_ip():
+    # Fly's proxy puts the real client address in this header
+    return request.headers.get("Fly-Client-IP", request.remote_addr)
+
+
+def login_rate_limited(ip):
+    now = time.monotonic()
+    with _LOGIN_LOCK:
+        for addr in list(_LOGIN_FAILURES):
+            failures = _LOGIN_FAILURES[addr]
+            while failures and now - failures[0] >= _LOGIN_TTL:
+                failures.popleft()
+            if not failures:
+                del _LOGIN_FAILURES[addr]
+        return len(_LOGIN_FAILURES.get(ip, ())) >= _LOGIN_MAX_FAILURES
+
+
+def record_login_failure(ip):
+    with _LOGIN_LOCK:
+        _LOGIN_FAILURES[ip].append(time.monotonic())
+
+
+# ---------------------------------------------------------------------------
+# HTTP caching
+# ---------------------------------------------------------------------------
+
+# Changes on every deploy so cached pages don't outlive the templates that built them.
+_ETAG_SALT = os.environ.get("FLY_IMAGE_REF") or str(time.time())
+
+
+# Rendered gallery pages keyed by ETag. The ETag carries gallery_version,
+# which every change to a post shown in the gallery bumps, so stale pages
+# are never served and just age out.
+_INDEX_CACHE = OrderedDict()
+_INDEX_CACHE_SIZE = 16
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def page_etag(*parts):
+    """Build an ETag for a page from the data it renders, or None if it must not be cached."""
+    # Pending flash messages are rendered once and then gone, so that page isn't repeatable.
+    if "_flashes" in session:
+        return None
+    key = repr((_ETAG_SALT, bool(session.get("logged_in"))) + parts)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def is_not_modified(etag):
+    # If-None-Match uses weak comparison (RFC 9110 13.1.2), so W/"..." from a proxy still matches
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+def cached_response(body, etag, vary=()):
+    resp = make_response(body)
+    if etag is not None:
+        resp.set_etag(etag)
+        # Always revalidate: the page changes as soon as something is posted.
+        resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.update(vary)
+    return resp
+
+
+def not_modified(etag, vary=()):
+    resp = cached_response("", etag, vary)
+    resp.status_code = 304
+    return resp
+
+
 # ---------------------------------------------------------------------------
 # Routes
 # ---------------------------------------------------------------------------
@@ -148,15 +465,45 @@ def login_required(f):
 @app.route("/")
 def index():
     db = get_db()
-    photos = db.execute(
-        """SELECT p.id, p.cloudinary_url, p.caption, p.created_at, p.media_type,
-                  COUNT(pi.id) AS image_count
-           FROM photos p
-           LEFT JOIN post_images pi ON p.id = pi.photo_id
-           GROUP BY p.id
-           ORDER BY p.created_at DESC"""
+    # Keyset pagination: each page starts after the (created_at, id) of the previous page's last card
+    before = request.args.get("before")
+    before_id = request.args.get("before_id", type=int)
+    cursor = (before, before_id) if before and before_id is not None else None
+    etag = page_etag(cursor, db.execute("SELECT version FROM gallery_version").fetchone()[0])
+    if is_not_modified(etag):
+        return not_modified(etag)
+    # Anonymous visitors all see the same page, so reuse its rendered HTML
+    shareable = etag is not None and not session.get("logged_in")
+    if shareable:
+        with _INDEX_CACHE_LOCK:
+            body = _INDEX_CACHE.get(etag)
+            if body is not None:
+                _INDEX_CACHE.move_to_end(etag)
+        if body is not None:
+            return cached_response(body, etag)
+    where = "WHERE (created_at, id) < (?, ?)" if cursor else ""
+    # Plain tuples instead of sqlite3.Row; the template unpacks them in column order
+    cur = db.cursor()
+    cur.row_factory = None
+    photos = cur.execute(
+        f"""SELECT id, cloudinary_url, cloudinary_public_id, caption, created_at, media_type, image_count
+            FROM photos {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?""",
+        (*(cursor or ()), PAGE_SIZE + 1),
     ).fetchall()
-    return render_template("index.html", photos=photos)
+    next_cursor = None
+    if len(photos) > PAGE_SIZE:
+        photos = photos[:PAGE_SIZE]
+        last_id, _, _, _, last_created_at, _, _ = photos[-1]
+        next_cursor = (last_created_at, last_id)
+    body = render_template("index.html", photos=photos, next_cursor=next_cursor, paged=cursor is not None)
+    if shareable:
+        with _INDEX_CACHE_LOCK:
+            _INDEX_CACHE[etag] = body
+            if len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+                _INDEX_CACHE.popitem(last=False)
+    return cached_response(body, etag)
 
 
 @app.route("/photo/<int:photo_id>")
@@ -165,12 +512,16 @@ def photo(photo_id):
     p = db.execute("SELECT * FROM photos WHERE id = ?", (photo_id,)).fetchone()
     if p is None:
         return render_template("404.html"), 404
+    wants_json = request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+    etag = page_etag(wants_json, p["id"], p["version"])
+    if is_not_modified(etag):
+        return not_modified(etag, vary=("Accept",))
     images = db.execute(
-        "SELECT cloudinary_url, media_type FROM post_images WHERE photo_id = ? ORDER BY display_order ASC",
+        "SELECT cloudinary_url, cloudinary_public_id, media_type FROM post_images WHERE photo_id = ? ORDER BY display_order ASC",
         (photo_id,),
     ).fetchall()
     if not images:
-        images = [{"cloudinary_url": p["cloudinary_url"], "media_type": p["media_type"]}]
+        images = [{"cloudinary_url": p["cloudinary_url"], "cloudinary_public_id": p["cloudinary_public_id"], "media_type": p["media_type"]}]
     all_comments = db.execute(
         "SELECT * FROM comments WHERE photo_id = ? ORDER BY created_at ASC",
         (photo_id,),
@@ -183,7 +534,15 @@ def photo(photo_id):
             top_level.append(comment_map[c["id"]])
         elif c["parent_id"] in comment_map:
             comment_map[c["parent_id"]]["replies"].append(comment_map[c["id"]])
-    return render_template("photo.html", photo=p, images=images, comments=top_level)
+    if wants_json:
+        body = jsonify(
+            photo={k: p[k] for k in ("id", "caption", "created_at", "media_type")},
+            images=[dict(img) for img in images],
+            comments=top_level,
+        )
+    else:
+        body = render_template("photo.html", photo=p, images=images, comments=top_level)
+    return cached_response(body, etag, vary=("Accept",))
 
 
 @app.route("/photo/<int:photo_id>/comment", methods=["POST"])
@@ -194,30 +553,32 @@ def add_comment(photo_id):
     if not name or not body:
         flash("Both name and comment are required.")
         return redirect(url_for("photo", photo_id=photo_id))
-    db = get_db()
-    if db.execute("SELECT id FROM photos WHERE id = ?", (photo_id,)).fetchone() is None:
-        return render_template("404.html"), 404
-    if parent_id is not None:
-        parent = db.execute("SELECT id FROM comments WHERE id = ? AND photo_id = ?", (parent_id, photo_id)).fetchone()
-        if parent is None:
-            parent_id = None
-    db.execute(
-        "INSERT INTO comments (photo_id, parent_id, name, body) VALUES (?, ?, ?, ?)",
-        (photo_id, parent_id, name, body),
-    )
-    db.commit()
+    with write_db() as db:
+        if parent_id is not None:
+            parent = db.execute("SELECT id FROM comments WHERE id = ? AND photo_id = ?", (parent_id, photo_id)).fetchone()
+            if parent is None:
+                parent_id = None
+        # The photo_id foreign key rejects comments on photos that don't exist
+        try:
+            db.execute(
+                "INSERT INTO comments (photo_id, parent_id, name, body) VALUES (?, ?, ?, ?)",
+                (photo_id, parent_id, name, body),
+            )
+        except sqlite3.IntegrityError:
+            return render_template("404.html"), 404
+        db.commit()
     return redirect(url_for("photo", photo_id=photo_id))
 
 
 @app.route("/photo/<int:photo_id>/comment/<int:comment_id>/like", methods=["POST"])
 @login_required
 def like_comment(photo_id, comment_id):
-    db = get_db()
-    c = db.execute("SELECT liked FROM comments WHERE id = ? AND photo_id = ?", (comment_id, photo_id)).fetchone()
-    if c is None:
-        return render_template("404.html"), 404
-    db.execute("UPDATE comments SET liked = ? WHERE id = ?", (0 if c["liked"] else 1, comment_id))
-    db.commit()
+    with write_db() as db:
+        c = db.execute("SELECT liked FROM comments WHERE id = ? AND photo_id = ?", (comment_id, photo_id)).fetchone()
+        if c is None:
+            return render_template("404.html"), 404
+        db.execute("UPDATE comments SET liked = ? WHERE id = ?", (0 if c["liked"] else 1, comment_id))
+        db.commit()
     return redirect(url_for("photo", photo_id=photo_id))
 
 
@@ -226,12 +587,17 @@ def login():
     if session.get("logged_in"):
         return redirect(url_for("upload"))
     if request.method == "POST":
+        ip = client_ip()
+        if login_rate_limited(ip):
+            flash("Too many login attempts. Try again in a minute.")
+            return render_template("login.html"), 429
         username = request.form.get("username", "")
         password = request.form.get("password", "")
-        if username == ADMIN_USERNAME and check_password_hash(ADMIN_PASSWORD_HASH, password):
+        if username == ADMIN_USERNAME and check_admin_password(password):
             session["logged_in"] = True
             flash("Welcome back!")
             return redirect(url_for("upload"))
+        record_login_failure(ip)
         flash("Invalid username or password.")
     return render_template("login.html")
 
@@ -261,30 +627,24 @@ def upload():
                 created_at = None
         else:
             created_at = None
-        uploaded = []
-        for f in files:
-            mtype = detect_media_type(f)
-            result = cloudinary.uploader.upload(f, folder="sharayunet", resource_type="auto")
-            uploaded.append((result["secure_url"], result["public_id"], mtype))
-        db = get_db()
+        uploaded = list(_CLOUDINARY_POOL.map(upload_to_cloudinary, files))
         first_url, first_public_id, first_mtype = uploaded[0]
-        if created_at:
-            cursor = db.execute(
-                "INSERT INTO photos (cloudinary_url, cloudinary_public_id, media_type, caption, created_at) VALUES (?, ?, ?, ?, ?)",
-                (first_url, first_public_id, first_mtype, caption or None, created_at),
-            )
-        else:
-            cursor = db.execute(
-                "INSERT INTO photos (cloudinary_url, cloudinary_public_id, media_type, caption) VALUES (?, ?, ?, ?)",
-                (first_url, first_public_id, first_mtype, caption or None),
-            )
-        photo_id = cursor.lastrowid
-        for i, (url, public_id, mtype) in enumerate(uploaded):
-            db.execute(
+        with write_db() as db, db:  # one transaction for the post and all its images
+            if created_at:
+                cursor = db.execute(
+                    "INSERT INTO photos (cloudinary_url, cloudinary_public_id, media_type, caption, image_count, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (first_url, first_public_id, first_mtype, caption or None, len(uploaded), created_at),
+                )
+            else:
+                cursor = db.execute(
+                    "INSERT INTO photos (cloudinary_url, cloudinary_public_id, media_type, caption, image_count) VALUES (?, ?, ?, ?, ?)",
+                    (first_url, first_public_id, first_mtype, caption or None, len(uploaded)),
+                )
+            photo_id = cursor.lastrowid
+            db.executemany(
                 "INSERT INTO post_images (photo_id, cloudinary_url, cloudinary_public_id, media_type, display_order) VALUES (?, ?, ?, ?, ?)",
-                (photo_id, url, public_id, mtype, i),
+                [(photo_id, url, public_id, mtype, i) for i, (url, public_id, mtype) in enumerate(uploaded)],
             )
-        db.commit()
         flash("Uploaded successfully!")
         return redirect(url_for("index"))
     return render_template("upload.html")
@@ -293,39 +653,35 @@ def upload():
 @app.route("/photo/<int:photo_id>/edit-date", methods=["POST"])
 @login_required
 def edit_photo_date(photo_id):
-    db = get_db()
-    if db.execute("SELECT id FROM photos WHERE id = ?", (photo_id,)).fetchone() is None:
-        return render_template("404.html"), 404
-    post_date = request.form.get("post_date", "").strip()
-    try:
-        created_at = datetime.strptime(post_date, "%Y-%m-%d").replace(hour=12).strftime("%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        flash("Invalid date.")
-        return redirect(url_for("photo", photo_id=photo_id))
-    db.execute("UPDATE photos SET created_at = ? WHERE id = ?", (created_at, photo_id))
-    db.commit()
+    with write_db() as db:
+        if db.execute("SELECT id FROM photos WHERE id = ?", (photo_id,)).fetchone() is None:
+            return render_template("404.html"), 404
+        post_date = request.form.get("post_date", "").strip()
+        try:
+            created_at = datetime.strptime(post_date, "%Y-%m-%d").replace(hour=12).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            flash("Invalid date.")
+            return redirect(url_for("photo", photo_id=photo_id))
+        db.execute("UPDATE photos SET created_at = ? WHERE id = ?", (created_at, photo_id))
+        db.commit()
     return redirect(url_for("photo", photo_id=photo_id))
 
 
 @app.route("/delete/<int:photo_id>", methods=["POST"])
 @login_required
 def delete_photo(photo_id):
-    db = get_db()
-    p = db.execute("SELECT * FROM photos WHERE id = ?", (photo_id,)).fetchone()
-    if p is None:
-        return render_template("404.html"), 404
-    imgs = db.execute(
-        "SELECT cloudinary_public_id, media_type FROM post_images WHERE photo_id = ?", (photo_id,)
-    ).fetchall()
-    if imgs:
-        for img in imgs:
-            rtype = "video" if img["media_type"] == "video" else "image"
-            cloudinary.uploader.destroy(img["cloudinary_public_id"], resource_type=rtype)
-    else:
-        rtype = "video" if p["media_type"] == "video" else "image"
-        cloudinary.uploader.destroy(p["cloudinary_public_id"], resource_type=rtype)
-    db.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
-    db.commit()
+    with write_db() as db:
+        p = db.execute("SELECT * FROM photos WHERE id = ?", (photo_id,)).fetchone()
+        if p is None:
+            return render_template("404.html"), 404
+        imgs = db.execute(
+            "SELECT cloudinary_public_id, media_type FROM post_images WHERE photo_id = ?", (photo_id,)
+        ).fetchall()
+        if not imgs:
+            imgs = [p]
+        db.execute("DELETE FROM photos WHERE id = ?", (photo_id,))
+        db.commit()
+    delete_from_cloudinary(imgs)
     flash("Deleted.")
     return redirect(url_for("index"))
 
@@ -334,12 +690,22 @@ def delete_photo(photo_id):
 # Entry point
 # ---------------------------------------------------------------------------
 
-with app.app_context():
-    init_db()
-    migrate_media_type()
-    migrate_post_images()
-    migrate_comment_likes()
-    migrate_comment_replies()
+# Each migration records its number in PRAGMA user_version and is skipped
+# once applied. Set RUN_MIGRATIONS=0 to skip the startup check entirely.
+if os.environ.get("RUN_MIGRATIONS", "1") == "1":
+    with app.app_context():
+        init_db()
+        migrate_media_type()
+        migrate_post_images()
+        migrate_comment_likes()
+        migrate_comment_replies()
+        migrate_image_count()
+        migrate_photos_created_index()
+        migrate_photo_version()
+
+# Compile every template now rather than on the first request that renders it
+for name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(name)
 
 if __name__ == "__main__":
     app.run(debug=True)
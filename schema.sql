@@ -4,6 +4,8 @@ CREATE TABLE IF NOT EXISTS photos (
     cloudinary_public_id TEXT NOT NULL,
     media_type TEXT NOT NULL DEFAULT 'image',
     caption TEXT,
+    image_count INTEGER NOT NULL DEFAULT 1,
+    version INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -17,6 +19,9 @@ CREATE TABLE IF NOT EXISTS post_images (
     FOREIGN KEY (photo_id) REFERENCES photos(id) ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS idx_photos_created_id ON photos(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_post_images_photo ON post_images(photo_id, display_order);
+
 CREATE TABLE IF NOT EXISTS comments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     photo_id INTEGER NOT NULL,
@@ -27,3 +32,14 @@ CREATE TABLE IF NOT EXISTS comments (
     FOREIGN KEY (photo_id) REFERENCES photos(id) ON DELETE CASCADE,
     FOREIGN KEY (parent_id) REFERENCES comments(id) ON DELETE CASCADE
 );
+
+CREATE INDEX IF NOT EXISTS idx_comments_photo ON comments(photo_id);
+
+-- Version counter for gallery ETags; it and photos.version are bumped by
+-- the triggers created in migrate_photo_version().
+CREATE TABLE IF NOT EXISTS gallery_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO gallery_version (id) VALUES (1);
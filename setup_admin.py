@@ -4,7 +4,7 @@ Run this script once to generate the ADMIN_PASSWORD_HASH value for your .env fil
 Usage:
     python setup_admin.py
 """
-from werkzeug.security import generate_password_hash
+from argon2 import PasswordHasher
 import getpass
 
 password = getpass.getpass("Enter admin password: ")
@@ -14,6 +14,6 @@ if password != confirm:
     print("Passwords do not match.")
     raise SystemExit(1)
 
-hashed = generate_password_hash(password)
+hashed = PasswordHasher().hash(password)
 print("\nAdd this to your .env file:")
 print(f"ADMIN_PASSWORD_HASH={hashed}")